@@ -1,18 +1,29 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
+import atexit
 import logging
+import logging.handlers
 import json
-import multiprocessing
+import os
+import queue
+import shutil
 import subprocess
 import sys
-import time
-from collections import defaultdict
 from dataclasses import dataclass
-from multiprocessing import Lock
-from multiprocessing.synchronize import Lock as LockType
-from itertools import repeat
 from pathlib import Path
-from typing import DefaultDict, Dict, List, Optional, Tuple
+from typing import (
+    AsyncIterator,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    TextIO,
+    Tuple,
+)
+
+logger = logging.getLogger(__name__)
 
 
 @dataclass
@@ -20,10 +31,13 @@ class Args:
     mapfile: Path
     cmd: Path
     max_cpus: int
+    max_jobs: Optional[int]
     cpu_arg: Optional[str]
     cpu_one: bool
     cmd_args: List[str]
     tmpdir: Path
+    persistent: bool
+    capture_output: bool
 
 
 def parse_args() -> Args:
@@ -71,6 +85,12 @@ def parse_args() -> Args:
         default=-1,
         help="max number of cpus to use overall with parallelization (default: %(default)s = run sequentially)",
     )
+    parser.add_argument(
+        "--py-jobs",
+        type=int,
+        metavar="INT",
+        help="max number of jobs to run at once. This can only lower the number of parallel jobs that is calculated from --py-maxcpus (default: no limit)",
+    )
     cpu_flag_args.add_argument(
         "--py-cpuarg",
         metavar="FLAG",
@@ -81,22 +101,35 @@ def parse_args() -> Args:
         action="store_true",
         help="use if cmd can only use 1 cpu with no option to change",
     )
+    parser.add_argument(
+        "--py-persistent",
+        action="store_true",
+        help="start one long-lived `cmd --serve` child per parallel job and send it each command over stdin instead of starting cmd again for every command. cmd must support this, see the README.",
+    )
+    parser.add_argument(
+        "--py-nooutput",
+        action="store_true",
+        help="discard the stdout and stderr of each job instead of logging it. Use for commands that write their results to files, so no pipe is needed per job.",
+    )
 
     config, args = parser.parse_known_args()
     return Args(
         mapfile=config.mapfile,
         cmd=config.cmd,
         max_cpus=config.py_maxcpus,
+        max_jobs=config.py_jobs,
         cpu_arg=config.py_cpuarg,
         cpu_one=config.py_cpuone,
         cmd_args=args,
         tmpdir=config.py_tempdir,
+        persistent=config.py_persistent,
+        capture_output=not config.py_nooutput,
     )
 
 
-def read_mapfile(mapfile: Path) -> DefaultDict[str, List[str]]:
-    """Read the `mapfile` into a dictionary to map the column names
-    to specific value instances. The `mapfile` needs to be in the format:
+def read_mapfile(fp: TextIO) -> Tuple[List[str], Optional[int]]:
+    """Read the column names of the `mapfile` and count its rows. The
+    `mapfile` needs to be in the format:
 
     ```
     VARARG1 VARARG2
@@ -108,102 +141,155 @@ def read_mapfile(mapfile: Path) -> DefaultDict[str, List[str]]:
 
     `-v1{VARARG1} -v2{VARARG2}`
 
+    No values are kept since `iter_commands` reads them straight from the
+    same `fp` as the commands are launched, which is left at the first row.
+    The mapfile is never opened twice, so it can also be a pipe or process
+    substitution, which can only be read once.
+
     Args:
-        mapfile (Path): tab-delimited file that maps variable arguments to
+        fp (TextIO): open tab-delimited file that maps variable arguments to
             specific values
 
     Returns:
-        DefaultDict[str, List[str]]: variable arg name mapped to a list of all
-            values for that specific arg. Each item in the list represents a single
+        Tuple[List[str], Optional[int]]: (column names, number of rows
+            excluding the header). The rows are only counted if `fp` is
+            seekable, otherwise the number of rows is None.
     """
-    logging.info(f"Reading mapfile: {mapfile}")
-    with mapfile.open() as fp:
-        header = fp.readline().rstrip().split("\t")
-        vararg_map: DefaultDict[str, List[str]] = defaultdict(list)
-        for line in fp:
-            values = line.rstrip().split("\t")
-            for column, value in zip(header, values):
-                vararg_map[column].append(value)
-    return vararg_map
-
-
-def split_args(args: List[str]) -> Tuple[List[str], List[str]]:
+    logger.info("Reading mapfile: %s", fp.name)
+    n_rows: Optional[int] = None
+    if fp.seekable():
+        # count newlines in large binary chunks rather than decoding and
+        # iterating every line just to throw it away
+        start = fp.tell()
+        n_lines = 0
+        chunk = b""
+        for chunk in iter(lambda: fp.buffer.read(1 << 20), b""):
+            n_lines += chunk.count(b"\n")
+        if chunk and not chunk.endswith(b"\n"):
+            # last row has no trailing newline
+            n_lines += 1
+        n_rows = max(n_lines - 1, 0)
+        fp.seek(start)
+
+    # the header is read as text, the same way `iter_commands` reads the
+    # rows, so both agree on line endings and encoding
+    header = fp.readline().rstrip("\n").split("\t")
+    return header, n_rows
+
+
+def parse_cmd_args(args: List[str]) -> Tuple[Dict[str, str], List[str]]:
     """Split the list of arguments that are for the command/executable into
-    constant and variable args based on their flags from the command line.
-    All variable args take the form of `-v{VARARG}`. Constant args are
-    everything else.
+    constant and variable args based on their flags from the command line,
+    and map the name of each header in the `mapfile` to the specific flag
+    that the command/executable takes as input. All variable args take the
+    form of `-v{VARARG}`. Constant args are everything else.
 
     Args:
         args (List[str]): arguments for the command/executable
 
     Returns:
-        Tuple[List[str], List[str]]: (variable args, constant args)
+        Tuple[Dict[str, str], List[str]]: (map from column name in `mapfile`
+            to the corresponding flag for the command/executable, constant args)
+
+    Raises:
+        ValueError: if a variable arg does not end with the `{VARARG}` column,
+            or if the same column is used by more than one variable arg
     """
-    varargs: List[str] = list()
+    column2flag: Dict[str, str] = dict()
     constargs: List[str] = list()
     for arg in args:
-        if "{" in arg:
-            # store var args
-            varargs.append(arg)
-        else:
-            # store constant args
+        # classify and split each arg in the same scan
+        idx = arg.find("{")
+        if idx < 0:
             constargs.append(arg)
-    return varargs, constargs
-
-
-def map_headers_to_flag(varargs: List[str]) -> Dict[str, str]:
-    """Parse the variable args list, and map the name of the header in the
-    `mapfile` to the specific flag that the command/executable takes as input.
+            continue
 
-    Args:
-        varargs (List[str]): variable args passed at the command line
-
-    Returns:
-        Dict[str, str]: maps column name in `mapfile` to the corresponding
-            flag for the command/executable
-    """
-    column2flag: Dict[str, str] = dict()
-    for arg in varargs:
         # CHANGE to accomodate positional variable args
         # TODO: technically does only if the config file has the same order as the commands
-        flag, column = arg.split("{")
-        column = column.replace("}", "")
-        column2flag[column] = flag
-
-    return column2flag
-
-
-def get_commands_list(
-    vararg_map: DefaultDict[str, List[str]],
+        if not arg.endswith("}"):
+            msg = f"Variable arg {arg} must take the form of -v{{VARARG}}."
+            logger.error(msg)
+            raise ValueError(msg)
+        column = arg[idx + 1 : -1]
+        if column in column2flag:
+            msg = f"Mapfile column {column} is used by more than one variable arg."
+            logger.error(msg)
+            raise ValueError(msg)
+        column2flag[column] = arg[:idx]
+
+    return column2flag, constargs
+
+
+def iter_commands(
+    fp: TextIO,
+    header: List[str],
     constargs: List[str],
     column2flag: Dict[str, str],
-) -> List[List[str]]:
-    """Given a list of `constargs`, the variable arguments map dictionary,
+) -> Iterator[List[str]]:
+    """Read the `mapfile` one row at a time and, given a list of `constargs`
     and a map from the variable args header names to the specific flags,
-    put all flags and arguments into a single object to group each
-    command instance together.
+    put all flags and arguments for each row into a single object to group
+    each command instance together.
+
+    Reading and building happen in a single lazy pass over the `mapfile`,
+    so the first jobs can start before the rest of the file is read, and
+    only the commands that are currently running are held in memory. Each
+    command is a single copy of `constargs` that the variable args are
+    appended to.
 
     Args:
-        vararg_map (DefaultDict[str, List[str]]): variable arg name mapped to a list of all
-            values for that specific arg. Each item in the list represents a single
+        fp (TextIO): open `mapfile`, positioned at the first row after the
+            header
+        header (List[str]): column names of the `mapfile`
         constargs (List[str]): list of all constant args, prepended with the executable name or path
         column2flag (Dict[str, str]): maps column name in `mapfile` to the corresponding
             flag for the command/executable
 
-    Returns:
-        List[List[str]]: list of commands where each item is a commands
-            list that can be passed directly to `subprocess.run`
+    Yields:
+        List[str]: commands list with the executable first
     """
-    commands = defaultdict(lambda: constargs.copy())
-    for colname, values in vararg_map.items():
-        flag = column2flag[colname]
-        for idx, value in enumerate(values):
+    flags = [column2flag[column] for column in header]
+    if len(flags) == 1:
+        # applying the command over a single column of inputs is the most
+        # common use, so skip splitting and zipping each row
+        flag = flags[0]
+        for line in fp:
+            value = line.rstrip("\n").partition("\t")[0]
+            command = constargs.copy()
+            command.append(flag)
+            if "," in value:
+                command.extend(value.split(","))
+            else:
+                command.append(value)
+            yield command
+        return
+
+    for line in fp:
+        command = constargs.copy()
+        # rows missing values for the last columns just leave those out
+        for flag, value in zip(flags, line.rstrip("\n").split("\t")):
+            command.append(flag)
             # TODO: prob change to semicolon or add arg
-            value = value.split(",")
-            commands[idx].append(flag)
-            commands[idx].extend(value)
+            if "," in value:
+                command.extend(value.split(","))
+            else:
+                command.append(value)
+        yield command
+
+
+def available_cpus() -> int:
+    """Count the CPUs this process is allowed to run on. Unlike
+    `os.cpu_count`, this respects the CPU affinity set by taskset or cgroup
+    cpusets, such as on HPC nodes or in containers.
 
-    return list(commands.values())
+    Returns:
+        int: number of usable CPUs
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # sched_getaffinity is not available on all platforms, ie macOS
+        return os.cpu_count() or 1
 
 
 def parse_cmd_cpu(constargs: List[str], cpu_arg: str) -> int:
@@ -212,47 +298,478 @@ def parse_cmd_cpu(constargs: List[str], cpu_arg: str) -> int:
         cmd_cpu = int(constargs[cmd_cpu_idx])
     except ValueError:
         # cpu_arg is not in constargs
-        logging.warning(
-            f"{cpu_arg} not found as a constant arg. Setting cpu usage per job to be 1. If your job can only use 1 cpu, then ignore this warning."
+        logger.warning(
+            "%s not found as a constant arg. Setting cpu usage per job to be 1. If your job can only use 1 cpu, then ignore this warning.",
+            cpu_arg,
         )
         cmd_cpu = 1
 
     return cmd_cpu
 
 
-def write_status_log(job2status: Dict[str, bool], status_file: Path):
-    with lock:
-        with status_file.open("w") as fp:
-            json.dump(job2status, fp, indent=4)
+class StatusLog:
+    """Checkpoint of which commands have already ran successfully, which is
+    saved to `status_file` so that a rerun can skip them.
+
+    Rewriting the whole file after every finished job costs time quadratic
+    in the number of jobs, so finished jobs are batched instead. The file is
+    rewritten at most once every `interval` seconds while jobs are running,
+    and `flush` must be called once they are done.
+
+    Args:
+        status_file (Path): checkpoint file, which is read if it exists
+        interval (float, optional): max seconds a finished job waits before
+            it is saved. Defaults to 1.0.
+    """
+
+    def __init__(self, status_file: Path, interval: float = 1.0):
+        self.status_file = status_file
+        self.interval = interval
+        self._pending_write: Optional[asyncio.TimerHandle] = None
+        if status_file.exists():
+            with status_file.open() as fp:
+                self.job2status: Dict[str, bool] = json.load(fp)
+        else:
+            # jobs missing from the status file have not ran yet
+            self.job2status = dict()
+
+    def has_ran(self, cmd_str: str) -> bool:
+        return self.job2status.get(cmd_str, False)
+
+    def mark_done(self, cmd_str: str):
+        self.job2status[cmd_str] = True
+        if self._pending_write is None:
+            loop = asyncio.get_running_loop()
+            self._pending_write = loop.call_later(self.interval, self.flush)
+
+    def flush(self):
+        """Write any jobs that finished since the last write to the status file."""
+        if self._pending_write is None:
+            return
+        self._pending_write.cancel()
+        self._pending_write = None
+        with self.status_file.open("w") as fp:
+            json.dump(self.job2status, fp, indent=4)
+
+
+def setup_child_watcher():
+    """Reap finished jobs from the event loop itself on Linux.
+
+    Before python 3.12, asyncio waits on every child process from its own
+    thread that blocks in `waitpid`, so running many short jobs in parallel
+    starts and stops a thread per job. A pidfd lets the event loop wait on
+    all of them at once instead. Python 3.12+ already does this by default.
+    """
+    if sys.version_info >= (3, 12) or not hasattr(asyncio, "PidfdChildWatcher"):
+        return
+    try:
+        # pidfds need linux 5.3+
+        os.close(os.pidfd_open(os.getpid()))
+    except OSError:
+        return
+    asyncio.set_child_watcher(asyncio.PidfdChildWatcher())
+
+
+def setup_logging(logfile: str):
+    """Log to `logfile` from a background thread. Records are only put onto
+    a queue by the event loop thread, so writing a busy log to disk never
+    holds up dispatching or reaping jobs.
+
+    Args:
+        logfile (str): file to write the log to
+    """
+    file_handler = logging.FileHandler(logfile)
+    file_handler.setFormatter(
+        logging.Formatter(
+            fmt="[%(asctime)s] %(levelname)s: %(message)s",
+            datefmt="%Y-%m-%d %H:%M:%S",
+        )
+    )
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener.start()
+    # write out any records still in the queue before exiting
+    atexit.register(listener.stop)
+
+
+async def iter_lines(stream: asyncio.StreamReader) -> AsyncIterator[str]:
+    """Read a child's output one line at a time as soon as each line is
+    written, so that output from long or verbose jobs never builds up in
+    memory beyond a single line.
 
+    Args:
+        stream (asyncio.StreamReader): output pipe of a child process
+
+    Yields:
+        str: each line without its trailing newline
+    """
+    partial = b""
+    while True:
+        try:
+            line = partial + await stream.readuntil(b"\n")
+        except asyncio.IncompleteReadError as err:
+            # child closed its output, so yield whatever is left without a newline
+            line = partial + err.partial
+            if line:
+                yield line.decode(errors="replace")
+            return
+        except asyncio.LimitOverrunError as err:
+            # line is longer than the stream buffer, so keep reading until it ends
+            partial += await stream.readexactly(err.consumed)
+            continue
+        partial = b""
+        yield line.decode(errors="replace").rstrip()
+
+
+async def log_output(job_id: int, stream: asyncio.StreamReader):
+    """Log each line of a job's output as soon as it is written.
+
+    Args:
+        job_id (int): index of the command in the mapfile
+        stream (asyncio.StreamReader): the job's combined stdout and stderr
+    """
+    async for line in iter_lines(stream):
+        logger.info("JOB %d: %s", job_id, line)
+
+
+async def kill_process(process: "asyncio.subprocess.Process") -> int:
+    """Kill a child process and wait for it to exit.
+
+    Before python 3.12, waiting on an asyncio child only returns once all of
+    its pipes are closed, which doesn't happen while a grandchild that
+    inherited them is still running. The pipes are closed along with the
+    kill, so an interrupted run never waits on grandchildren.
+
+    Args:
+        process (asyncio.subprocess.Process): child process to kill
+
+    Returns:
+        int: exit code of the child
+    """
+    process.kill()
+    # asyncio has no public way to get at the pipes of a child process. Only
+    # the pipes are closed, so the child is still reaped by the event loop.
+    transport = process._transport  # type: ignore[attr-defined]
+    for fd in (0, 1, 2):
+        pipe = transport.get_pipe_transport(fd)
+        if pipe is not None:
+            pipe.close()
+    return await process.wait()
+
+
+class CommandServer:
+    """A long-lived `cmd --serve` child that runs one command after another,
+    so that slow startup of `cmd`, such as loading an interpreter, is only
+    paid once per parallel job instead of once per command.
+
+    Each command is sent to the server's stdin as a single line with the JSON
+    list of its args, not including the executable. The server must then
+    reply with a single line on stdout holding the exit code of that command.
+    Everything the server writes to stderr is logged under the job that was
+    most recently sent to it. The server should exit once its stdin is closed.
+
+    The server is only started when the first command is sent, and is started
+    again for the next command if it dies.
+
+    Args:
+        executable (str): path to the executable
+        capture_output (bool, optional): log the server's stderr instead of
+            discarding it. Defaults to True.
+    """
+
+    def __init__(self, executable: str, capture_output: bool = True):
+        self.executable = executable
+        self.capture_output = capture_output
+        self.job_id = -1
+        self._process: Optional[asyncio.subprocess.Process] = None
+        self._stderr: Optional["asyncio.Future[None]"] = None
+
+    async def _log_stderr(self, stream: asyncio.StreamReader):
+        async for line in iter_lines(stream):
+            logger.info("JOB %d: %s", self.job_id, line)
+
+    async def run(self, job_id: int, command: List[str]) -> int:
+        """Send a single command to the server and wait for it to finish.
+
+        Args:
+            job_id (int): index of the command in the mapfile
+            command (List[str]): commands list with the executable first
+
+        Returns:
+            int: exit code of the command that the server replied with
+
+        Raises:
+            ChildProcessError: if the server exits before replying
+            RuntimeError: if the server does not reply with an exit code
+        """
+        if self._process is None:
+            self._process = await asyncio.create_subprocess_exec(
+                self.executable,
+                "--serve",
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=(
+                    asyncio.subprocess.PIPE
+                    if self.capture_output
+                    else asyncio.subprocess.DEVNULL
+                ),
+                close_fds=False,
+            )
+            if self.capture_output:
+                self._stderr = asyncio.ensure_future(
+                    self._log_stderr(self._process.stderr)
+                )
+        process = self._process
+        self.job_id = job_id
+
+        try:
+            process.stdin.write(json.dumps(command[1:]).encode() + b"\n")
+            await process.stdin.drain()
+            reply = await process.stdout.readline()
+        except (BrokenPipeError, ConnectionResetError):
+            reply = b""
+        except asyncio.CancelledError:
+            # interrupted, so don't leave the server running without its event loop
+            logger.warning("JOB %d: Interrupted -- killing its server.", job_id)
+            await self.close(kill=True)
+            raise
+
+        if not reply:
+            # the server may exit with code 0 here, so this is not reported as
+            # the command itself exiting with a non-zero code. It's logged by
+            # `run_worker` like any other job that couldn't run.
+            returncode = await self.close()
+            raise ChildProcessError(
+                f"{self.executable} --serve exited with code {returncode} before replying"
+            )
 
-def run_command(
+        try:
+            return int(reply)
+        except ValueError:
+            await self.close(kill=True)
+            msg = f"{self.executable} --serve replied {reply!r} instead of an exit code."
+            logger.error(msg)
+            raise RuntimeError(msg)
+
+    async def close(self, kill: bool = False) -> int:
+        """Stop the server, if it is running, and wait for it to exit.
+
+        Args:
+            kill (bool, optional): kill the server instead of closing its
+                stdin and letting it exit on its own. Defaults to False.
+
+        Returns:
+            int: exit code of the server, or 0 if it was not running
+        """
+        process, self._process = self._process, None
+        if process is None:
+            return 0
+        if kill:
+            returncode = await kill_process(process)
+        else:
+            process.stdin.close()
+            returncode = await process.wait()
+        if self._stderr is not None:
+            await self._stderr
+        return returncode
+
+
+async def run_command(
     job_id: int,
     command: List[str],
-    job2status: Dict[str, bool],
-    status_file: Path,
+    executable: str,
+    status_log: StatusLog,
+    server: Optional[CommandServer] = None,
+    capture_output: bool = True,
 ):
+    """Run a single command as a child process, and checkpoint it if it ran
+    successfully. Everything the command writes to stdout or stderr is
+    logged as it is written.
+
+    Args:
+        job_id (int): index of the command in the mapfile
+        command (List[str]): commands list with the executable first
+        executable (str): path to the executable, which is what actually gets
+            ran while `command[0]` is left as it was passed at the command line
+        status_log (StatusLog): checkpoint of the commands that already ran
+        server (Optional[CommandServer], optional): long-lived server to send
+            the command to instead of starting a new child. Defaults to None.
+        capture_output (bool, optional): log the command's stdout and stderr.
+            Otherwise they are sent to /dev/null without opening a pipe.
+            Defaults to True.
+
+    Raises:
+        subprocess.CalledProcessError: if the command exits with a non-zero code
+    """
+    # the joined command is needed as the checkpoint key anyway, but the log
+    # messages themselves are only formatted if INFO logging is enabled
     cmd_str = " ".join(command)
-    logging.info(f"JOB {job_id}: {cmd_str}")
-    if not job2status[cmd_str]:
-        # run job bc hasn't ran
-        try:
-            subprocess.check_output(command)
-        except subprocess.CalledProcessError as err:
-            logging.error(f"JOB {job_id}: {err.stderr.decode().rstrip()}")
-            time.sleep(60)
-            raise err
-        else:
-            logging.info(f"JOB {job_id}: Ran sucessfully")
-            job2status[cmd_str] = True
-            write_status_log(job2status, status_file)
+    logger.info("JOB %d: %s", job_id, cmd_str)
+    if status_log.has_ran(cmd_str):
+        logger.info("JOB %d: Already ran -- skipping.", job_id)
+        return
+
+    # run job bc hasn't ran
+    if server is not None:
+        returncode = await server.run(job_id, command)
     else:
-        logging.info(f"JOB {job_id}: Already ran -- skipping.")
+        # an executable with a directory and close_fds=False lets subprocess use
+        # posix_spawn instead of fork+exec. This is safe since python opens all
+        # fds as non-inheritable anyway.
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            executable=executable,
+            stdout=(
+                asyncio.subprocess.PIPE
+                if capture_output
+                else asyncio.subprocess.DEVNULL
+            ),
+            stderr=(
+                asyncio.subprocess.STDOUT
+                if capture_output
+                else asyncio.subprocess.DEVNULL
+            ),
+            close_fds=False,
+        )
+        try:
+            if capture_output:
+                await log_output(job_id, process.stdout)
+            returncode = await process.wait()
+        except asyncio.CancelledError:
+            # interrupted, so don't leave the child running without its event loop
+            logger.warning("JOB %d: Interrupted -- killing it.", job_id)
+            await kill_process(process)
+            raise
+    if returncode != 0:
+        logger.error("JOB %d: Exited with code %d", job_id, returncode)
+        raise subprocess.CalledProcessError(returncode, command)
+
+    logger.info("JOB %d: Ran sucessfully", job_id)
+    status_log.mark_done(cmd_str)
+
+
+async def run_worker(
+    pending: Iterator[Tuple[int, List[str]]],
+    executable: str,
+    status_log: StatusLog,
+    persistent: bool = False,
+    capture_output: bool = True,
+) -> Optional[Exception]:
+    """Keep running the next command from `pending` until there are none
+    left. Several workers share the same `pending` iterator, so each one
+    pulls a new command as soon as its previous one finishes.
 
+    Args:
+        pending (Iterator[Tuple[int, List[str]]]): shared iterator of
+            (job id, command) for each command that has not started
+        executable (str): path to the executable
+        status_log (StatusLog): checkpoint of the commands that already ran
+        persistent (bool, optional): send every command to a single
+            long-lived `CommandServer` instead of starting a new child for
+            each one. Defaults to False.
+        capture_output (bool, optional): log the stdout and stderr of each
+            command. Defaults to True.
 
-def init_process_pool(input_lock: LockType):
-    global lock
-    lock = input_lock
+    Returns:
+        Optional[Exception]: the first error this worker ran into, if any
+    """
+    failure: Optional[Exception] = None
+    server = CommandServer(executable, capture_output) if persistent else None
+    try:
+        for job_id, command in pending:
+            try:
+                await run_command(
+                    job_id,
+                    command,
+                    executable,
+                    status_log,
+                    server,
+                    capture_output,
+                )
+            except subprocess.CalledProcessError as err:
+                # already logged with the job's exit code
+                if failure is None:
+                    failure = err
+            except OSError as err:
+                # job couldn't be started, so nothing has been logged for it yet
+                logger.error("JOB %d: %s", job_id, err)
+                if failure is None:
+                    failure = err
+    finally:
+        if server is not None:
+            await server.close()
+    return failure
+
+
+async def run_commands(
+    commands: Iterable[List[str]],
+    executable: str,
+    jobs: int,
+    status_log: StatusLog,
+    persistent: bool = False,
+    capture_output: bool = True,
+):
+    """Run each command as a child process, keeping at most `jobs` of them
+    alive at once. All children are waited on from a single event loop, so
+    a new job is started as soon as any running job finishes without
+    needing a pool of worker threads or processes.
+
+    Only `jobs` worker coroutines are created, and they pull from
+    `commands` as they go, so no per-command task or command list is
+    built ahead of time.
+
+    Args:
+        commands (Iterable[List[str]]): commands lists with the executable
+            first, which are only consumed as jobs start
+        executable (str): path to the executable
+        jobs (int): max number of jobs to run at once
+        status_log (StatusLog): checkpoint of the commands that already ran
+        persistent (bool, optional): have each worker send its commands to a
+            long-lived `cmd --serve` child. Defaults to False.
+        capture_output (bool, optional): log the stdout and stderr of each
+            command. Defaults to True.
+
+    Raises:
+        subprocess.CalledProcessError: if any job failed. All remaining jobs
+            are still ran before raising the first failure.
+        OSError: if a job could not be started, or if a `cmd --serve` child
+            exited before replying
+        RuntimeError: if a `cmd --serve` child does not reply with an exit code
+    """
+    pending = enumerate(commands)
+    workers = [
+        asyncio.ensure_future(
+            run_worker(
+                pending, executable, status_log, persistent, capture_output
+            )
+        )
+        for _ in range(jobs)
+    ]
+    try:
+        failures = await asyncio.gather(*workers)
+    except asyncio.CancelledError:
+        # gather cancels every worker but returns as soon as the first one
+        # stops, so wait for the rest to kill their jobs before the event
+        # loop is closed
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise
+    except Exception:
+        # a worker hit an error it doesn't handle, which gather raises right
+        # away, so stop the rest before the last write of the status file.
+        # Otherwise jobs that finish after it are never checkpointed.
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise
+    finally:
+        # save jobs that finished since the last write, even if interrupted
+        status_log.flush()
+    for failure in failures:
+        if failure is not None:
+            raise failure
 
 
 def main():
@@ -260,6 +777,7 @@ def main():
     mapfile = args.mapfile
     cmd = args.cmd
     max_cpus = args.max_cpus
+    max_jobs = args.max_jobs
     cpu_arg = args.cpu_arg
     cpu_one = args.cpu_one
     tmpdir = args.tmpdir
@@ -267,71 +785,97 @@ def main():
     status_file = tmpdir.joinpath(".status")
 
     logfile = f"{cmd.stem}_commands.log"
-    logging.basicConfig(
-        filename=logfile,
-        level=logging.INFO,
-        format="[%(asctime)s] %(levelname)s: %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
-    )
+    setup_logging(logfile)
 
-    vararg_map = read_mapfile(mapfile)
-    varargs, constargs = split_args(args.cmd_args)
-
-    constargs.insert(0, cmd.as_posix())
+    # the mapfile is only opened once since it may be a pipe that can only
+    # be read once
+    with mapfile.open() as fp:
+        header, n_tasks = read_mapfile(fp)
+        column2flag, cmd_args = parse_cmd_args(args.cmd_args)
+        constargs = [cmd.as_posix(), *cmd_args]
+
+        # look up the executable once rather than searching $PATH for every job
+        executable = shutil.which(cmd.as_posix())
+        if executable is None:
+            msg = f"{cmd} is not an executable file or is not in your $PATH."
+            logger.error(msg)
+            raise RuntimeError(msg)
+        executable = os.path.abspath(executable)
+
+        duplicated = sorted({column for column in header if header.count(column) > 1})
+        if duplicated:
+            msg = f"Mapfile columns {duplicated} appear more than once in the header."
+            logger.error(msg)
+            raise RuntimeError(msg)
+
+        # every column needs a variable arg and every variable arg needs a column
+        missing = [column for column in header if column not in column2flag]
+        unmatched = [column for column in column2flag if column not in header]
+        if missing or unmatched:
+            msg = (
+                "Mapfile columns do not match the variable args passed. "
+                f"Mapfile columns without a variable arg: {missing}. "
+                f"Variable args without a mapfile column: {unmatched}."
+            )
+            logger.error(msg)
+            raise RuntimeError(msg)
+
+        n_cpus = available_cpus()
+        if max_cpus > n_cpus:
+            logger.warning(
+                "--py-maxcpus %d is more than the %d CPUs available. Using %d instead.",
+                max_cpus,
+                n_cpus,
+                n_cpus,
+            )
+            max_cpus = n_cpus
+
+        if cpu_one:
+            # JOB only uses 1 CPU by default
+            cmd_cpus = 1
+        elif cpu_arg is not None:
+            cmd_cpus = parse_cmd_cpu(constargs, cpu_arg)
+        else:
+            # --py-cpuarg was not supplied with --py-maxcpus
+            # forces running to go back to sequential mode
+            cmd_cpus = max_cpus
 
-    if len(vararg_map) != len(varargs):
-        msg = "Number of variable args passed does not equal the number of columns in the mapfile."
-        logging.error(msg)
-        raise RuntimeError(msg)
+        ## This is for checkpointing individual jobs
+        status_log = StatusLog(status_file)
 
-    column2flag = map_headers_to_flag(varargs)
-    commands = get_commands_list(vararg_map, constargs, column2flag)
-    n_tasks = len(commands)
+        if cmd_cpus <= 0 or max_cpus <= cmd_cpus:
+            # jobs can't be split up by cpu usage, so nothing runs in parallel
+            jobs = 1
+        else:
+            jobs = max_cpus // cmd_cpus
+        if max_jobs is not None:
+            jobs = min(jobs, max_jobs)
+        if n_tasks is not None:
+            # no point in starting more workers than there are tasks for them to run
+            jobs = min(jobs, n_tasks)
+        # a mapfile that can only be read once, like a pipe, is not counted
+        n_tasks_str = "all" if n_tasks is None else str(n_tasks)
+
+        if jobs <= 1:
+            # DEFAULTS BACK TO SEQUENTIAL
+            # This is basically the default state, or there is nothing to parallelize
+            jobs = 1
+            logger.info("Running %s tasks sequentially", n_tasks_str)
+        else:
+            # PARALLEL BLOCK
+            logger.info("Running %s tasks in parallel batches of %d", n_tasks_str, jobs)
 
-    if cpu_one:
-        # JOB only uses 1 CPU by default
-        cmd_cpus = 1
-    elif cpu_arg is not None:
-        cmd_cpus = parse_cmd_cpu(constargs, cpu_arg)
-    else:
-        # --py-cpuarg was not supplied with --py-maxcpus
-        # forces running to go back to sequential mode
-        cmd_cpus = max_cpus
-
-    lock = Lock()
-    ## This is for checkpointing individual jobs
-    if not status_file.exists():
-        job2status = dict()
-        for command in commands:
-            cmd_str = " ".join(command)
-            job2status[cmd_str] = False
-    else:
-        with status_file.open() as fp:
-            job2status = json.load(fp)
-
-    if max_cpus <= cmd_cpus:
-        # DEFAULTS BACK TO SEQUENTIAL
-        # This is basically the default state
-        jobs = 1
-        logging.info(f"Running {n_tasks} tasks sequentially")
-    else:
-        # PARALLEL BLOCK
-        jobs = max_cpus // cmd_cpus
-        logging.info(f"Running {n_tasks} tasks in parallel batches of {jobs}")
-
-    with multiprocessing.Pool(
-        processes=jobs,
-        initializer=init_process_pool,
-        initargs=(lock,),
-    ) as pool:
-        pool.starmap(
-            run_command,
-            zip(
-                range(len(commands)),
+        commands = iter_commands(fp, header, constargs, column2flag)
+        setup_child_watcher()
+        asyncio.run(
+            run_commands(
                 commands,
-                repeat(job2status),
-                repeat(status_file),
-            ),
+                executable,
+                jobs,
+                status_log,
+                args.persistent,
+                args.capture_output,
+            )
         )
 
 